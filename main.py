@@ -1,9 +1,11 @@
 import argparse
-import json
+import asyncio
 import logging
 import os
 import sys
 
+import orjson
+
 from terraform_agents.terraform_enhancer import TerraformEnhancer
 
 # Configure logging
@@ -32,8 +34,18 @@ def parse_args():
         choices=["openai", "anthropic"],
         help="LLM provider",
     )
+    parser.add_argument(
+        "--mode",
+        choices=["interactive", "batch"],
+        help="Use the provider's batch API for cheaper but slower runs",
+    )
     parser.add_argument("--github-token", help="GitHub token for private repositories")
     parser.add_argument("--config", help="Path to configuration file")
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Disable the persistent LLM response cache",
+    )
     return parser.parse_args()
 
 
@@ -45,17 +57,21 @@ def main():
     config = {}
     if args.config and os.path.exists(args.config):
         with open(args.config) as f:
-            config = json.load(f)
+            config = orjson.loads(f.read())
 
     # Override config with command-line arguments
     if args.api_key:
         config["api_key"] = args.api_key
     if args.provider:
         config["provider"] = args.provider
+    if args.mode:
+        config["mode"] = args.mode
     if args.github_token:
         config["github_token"] = args.github_token
     if args.output:
         config["output_dir"] = args.output
+    if args.no_cache:
+        config["cache_dir"] = None
 
     # Check for required configuration
     if "api_key" not in config:
@@ -69,7 +85,9 @@ def main():
 
     try:
         # Enhance the Terraform code
-        modified_files = enhancer.enhance_terraform_code(args.repo, args.prompt)
+        modified_files = asyncio.run(
+            enhancer.enhance_terraform_code(args.repo, args.prompt)
+        )
 
         # Print summary
         print(f"\nEnhanced {len(modified_files)} files:")
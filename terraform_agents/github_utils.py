@@ -1,14 +1,22 @@
+import asyncio
 import logging
 import os
 import re
 import shutil
+import stat
 import tempfile
+import time
+from typing import Any
+from typing import Callable
 from typing import Optional
 
 from git import Repo
 
 logger = logging.getLogger("terraform-agent")
 
+RMTREE_ATTEMPTS = 3
+RMTREE_RETRY_DELAY_S = 0.1
+
 
 class GitHubRepo:
     """Handles GitHub repository operations including nested folders"""
@@ -78,13 +86,13 @@ class GitHubRepo:
         Returns:
             Path to the cloned repository or nested folder within it
         """
-        self.temp_dir = tempfile.mkdtemp()
-        logger.info(f"Cloning {self.clone_url} to {self.temp_dir}")
+        temp_dir = self.temp_dir = tempfile.mkdtemp()
+        logger.info(f"Cloning {self.clone_url} to {temp_dir}")
 
         try:
             # Clone the repository - try with auth URL first
             try:
-                Repo.clone_from(self.auth_url, self.temp_dir, branch=self.branch)
+                self._clone_from(self.auth_url, temp_dir)
                 logger.info("Repository cloned successfully using authentication")
             except Exception as e:
                 # If authentication fails or token is not provided, try without auth
@@ -92,14 +100,14 @@ class GitHubRepo:
                     logger.info(
                         "Trying to clone without authentication (public repository)"
                     )
-                    Repo.clone_from(self.clone_url, self.temp_dir, branch=self.branch)
+                    self._clone_from(self.clone_url, temp_dir)
                     logger.info("Repository cloned successfully as public repository")
                 else:
                     raise
 
             # If a nested path is specified, return the path to that directory
             if self.nested_path:
-                nested_dir = os.path.join(self.temp_dir, self.nested_path)
+                nested_dir = os.path.join(temp_dir, self.nested_path)
                 if os.path.exists(nested_dir):
                     logger.info(f"Using nested directory: {self.nested_path}")
                     return nested_dir
@@ -110,19 +118,73 @@ class GitHubRepo:
                     )
 
             # If no nested path or it doesn't exist, return the repo root
-            return self.temp_dir
+            return temp_dir
 
         except Exception as e:
             logger.error(f"Failed to clone repository: {str(e)}")
             self.cleanup()
             raise
 
+    async def clone_async(self) -> str:
+        """
+        Clone the repository without blocking the event loop
+
+        GitPython drives git synchronously, so the clone runs in a worker
+        thread and other setup work can overlap with it.
+
+        Returns:
+            Path to the cloned repository or nested folder within it
+        """
+        return await asyncio.to_thread(self.clone)
+
+    def _clone_from(self, url: str, temp_dir: str) -> None:
+        """
+        Clone only what is needed from the given URL into the temporary directory
+
+        This makes a shallow, blobless clone of the branch and, when a nested
+        path is set, a sparse checkout of just that subtree, so large
+        monorepos don't have to be downloaded in full.
+        """
+        # Never block waiting for credentials on the terminal
+        env = {"GIT_TERMINAL_PROMPT": "0"}
+        repo = Repo.clone_from(
+            url,
+            temp_dir,
+            env=env,
+            branch=self.branch,
+            depth=1,
+            filter="blob:none",
+            no_checkout=True,
+        )
+        repo.git.update_environment(**env)
+
+        if self.nested_path:
+            repo.git.sparse_checkout("init", "--cone")
+            repo.git.sparse_checkout("set", self.nested_path)
+        repo.git.checkout(self.branch)
+
     def cleanup(self) -> None:
         """Clean up the temporary directory"""
         if self.temp_dir and os.path.exists(self.temp_dir):
             logger.info(f"Cleaning up temporary directory: {self.temp_dir}")
-            import time
-
-            time.sleep(1)
-            shutil.rmtree(self.temp_dir)
+            shutil.rmtree(self.temp_dir, onerror=self._rmtree_retry)
             self.temp_dir = None
+
+    def _rmtree_retry(
+        self, func: Callable[[str], Any], path: str, exc_info: Any
+    ) -> None:
+        """
+        Retry removing a path that shutil.rmtree failed to remove
+
+        Git marks its object files read-only and Windows may briefly keep
+        file handles open, so make the path writable and retry a few times.
+        """
+        for attempt in range(1, RMTREE_ATTEMPTS + 1):
+            try:
+                os.chmod(path, stat.S_IWRITE)
+                func(path)
+                return
+            except OSError:
+                if attempt == RMTREE_ATTEMPTS:
+                    raise
+                time.sleep(RMTREE_RETRY_DELAY_S)
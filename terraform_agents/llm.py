@@ -1,34 +1,63 @@
+import asyncio
+import importlib.util
 import json
 import logging
 import re
+import sqlite3
+import time
+from collections.abc import Awaitable
+from typing import Any
+from typing import Callable
+from typing import Optional
+
+import orjson
+
+from terraform_agents.llm_cache import DEFAULT_CACHE_DIR
+from terraform_agents.llm_cache import LLMCache
+from terraform_agents.stream_parser import StreamingJSONParser
 
 
 logger = logging.getLogger("terraform-agent")
 
+OPENAI_MODEL = "gpt-4o"
+ANTHROPIC_MODEL = "claude-3-7-sonnet-20250219"
 
-class LLMClient:
-    """Client for communicating with LLM APIs"""
+# Bump whenever SYSTEM_PROMPT or the user message template changes so that
+# cached responses produced by an older template are no longer reused
+PROMPT_VERSION = "v2"
 
-    def __init__(self, api_key: str, provider: str = "openai"):
-        """Initialize with API key and provider"""
-        self.api_key = api_key
-        self.provider = provider.lower()
+DEFAULT_MAX_CONCURRENCY = 10
 
-    def update_terraform_code(
-        self, files_dict: dict[str, str], prompt: str
-    ) -> dict[str, str]:
-        """
-        Send files to the LLM with a prompt to update them
+# Pack several small files into a single request to make better use of the
+# tokens-per-minute limit without running into the requests-per-minute limit
+DEFAULT_ROWS_PER_CALL = 8
+SHARD_TOKEN_BUDGET = 6000
 
-        Args:
-            files_dict: Dictionary mapping file paths to their contents
-            prompt: User prompt for code modification
+# Context window and the completion limit we allow for each model. The
+# Anthropic limit is kept low enough for non-streaming requests to be accepted.
+CONTEXT_WINDOWS = {OPENAI_MODEL: 128000, ANTHROPIC_MODEL: 200000}
+MAX_OUTPUT_TOKENS = {OPENAI_MODEL: 16384, ANTHROPIC_MODEL: 16384}
+RESERVED_OUTPUT_TOKENS = 4096
 
-        Returns:
-            Dictionary of updated file contents
-        """
-        # Prepare system prompt
-        system_prompt = """
+# Called with (file_path, content) as soon as each modified file is available
+FileCallback = Callable[[str, str], Awaitable[None]]
+
+# Transient errors (rate limits, timeouts, 5xx) are retried by the SDKs with
+# exponential backoff and jitter
+DEFAULT_MAX_RETRIES = 3
+
+# Both SDKs wait 10 minutes by default, far too long to notice that a shard is
+# too big for the model to answer in time
+DEFAULT_REQUEST_TIMEOUT = 300.0
+
+# Connection pool shared by all concurrent requests of a client
+MAX_CONNECTIONS = 64
+MAX_KEEPALIVE_CONNECTIONS = 32
+
+BATCH_POLL_INITIAL_S = 10
+BATCH_POLL_MAX_S = 300
+
+SYSTEM_PROMPT = """
         You are an expert Terraform developer specializing in AWS infrastructure. \
         Your task is to analyze and modify Terraform code according to the user's requirements.
 
@@ -39,7 +68,7 @@ class LLMClient:
         4. Maintain the existing code structure and style
         5. Document your changes with comments
         6. Return all modified files with their complete content
-        7. Format the output as JSON with the file path as key and modified content as value
+        7. Format the output as JSON with the file id as key and modified content as value
 
         Before making changes:
         - Identify all dependencies between files to ensure your modifications are consistent
@@ -50,76 +79,839 @@ class LLMClient:
         - If the user asks for cost optimizations, focus on resource sizing, reserved instances, lifecycle policies, etc.
         """
 
-        # Format the files content for the prompt
-        files_content = ""
-        for file_path, content in files_dict.items():
-            files_content += f"\n\n--- File: {file_path} ---\n\n{content}"
+
+class LLMTimeoutError(Exception):
+    """Raised when a request to the LLM API times out"""
+
+
+class LLMRequestError(Exception):
+    """Raised when a request to the LLM API fails for any other reason"""
+
+
+class LLMClient:
+    """Client for communicating with LLM APIs"""
+
+    def __init__(
+        self,
+        api_key: str,
+        provider: str = "openai",
+        cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        rows_per_call: int = DEFAULT_ROWS_PER_CALL,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        hedge_delay: Optional[float] = None,
+        request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+    ):
+        """Initialize with API key, provider and an optional response cache directory"""
+        self.api_key = api_key
+        self.provider = provider.lower()
+        self.model = ANTHROPIC_MODEL if self.provider == "anthropic" else OPENAI_MODEL
+        self.cache: Optional[LLMCache] = None
+        if cache_dir:
+            # The cache is only an optimization, so run without it if it can't be opened
+            try:
+                self.cache = LLMCache(cache_dir)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"LLM response cache disabled: {str(e)}")
+        self.max_concurrency = max_concurrency
+        self.rows_per_call = rows_per_call
+        self.max_retries = max_retries
+        self.hedge_delay = hedge_delay
+        self.request_timeout = request_timeout
+        self._encoding: Optional[Any] = None
+        self._tiktoken_unavailable = False
+        self._client: Optional[Any] = None
+        self._async_client: Optional[Any] = None
+        self._async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def update_terraform_code(
+        self,
+        files_dict: dict[str, str],
+        prompt: str,
+        file_groups: Optional[list[list[str]]] = None,
+    ) -> dict[str, str]:
+        """Synchronous wrapper around update_terraform_code_async"""
+        return asyncio.run(
+            self.update_terraform_code_async(files_dict, prompt, file_groups)
+        )
+
+    async def update_terraform_code_async(
+        self,
+        files_dict: dict[str, str],
+        prompt: str,
+        file_groups: Optional[list[list[str]]] = None,
+        on_file: Optional[FileCallback] = None,
+    ) -> dict[str, str]:
+        """
+        Send files to the LLM with a prompt to update them
+
+        Groups of related files are packed into requests of up to
+        rows_per_call files, the requests are sent concurrently and the
+        modified files from each response are merged together.
+
+        Args:
+            files_dict: Dictionary mapping file paths to their contents
+            prompt: User prompt for code modification
+            file_groups: Optional groups of file paths that must be edited together
+            on_file: Optional callback invoked for each modified file as soon as
+                it has been generated, before the whole response is complete
+
+        Returns:
+            Dictionary of updated file contents
+        """
+        shards = self._build_shards(files_dict, file_groups, prompt)
+        logger.info(f"Sending {len(shards)} requests to the LLM")
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = await asyncio.gather(
+            *[
+                self._update_shard(shard, files_dict, prompt, semaphore, on_file)
+                for shard in shards
+            ]
+        )
+
+        modified_files: dict[str, str] = {}
+        for result in results:
+            modified_files.update(result)
+        return modified_files
+
+    def update_terraform_code_batch(
+        self,
+        files_dict: dict[str, str],
+        prompt: str,
+        file_groups: Optional[list[list[str]]] = None,
+    ) -> dict[str, str]:
+        """
+        Send files to the LLM through the provider's batch API
+
+        Batch requests are billed at a discount but may take up to 24 hours
+        to complete, so this is meant for non-interactive runs such as CI.
+
+        Args:
+            files_dict: Dictionary mapping file paths to their contents
+            prompt: User prompt for code modification
+            file_groups: Optional groups of file paths that must be edited together
+
+        Returns:
+            Dictionary of updated file contents
+        """
+        modified_files: dict[str, str] = {}
+        pending: dict[str, tuple[str, str]] = {}
+
+        shards = self._build_shards(files_dict, file_groups, prompt)
+        shard_files: dict[str, dict[str, str]] = {}
+        for index, shard in enumerate(shards):
+            files = self._shard_files(shard, files_dict)
+            cache_key = self._cache_key(files, prompt)
+            cached = self.cache.get(cache_key) if self.cache else None
+            if cached is not None:
+                logger.info(f"Using cached LLM response for {len(cached)} files")
+                modified_files.update(cached)
+            else:
+                custom_id = f"shard-{index}"
+                shard_files[custom_id] = files
+                pending[custom_id] = (
+                    cache_key,
+                    self._build_user_message(files, prompt),
+                )
+
+        if not pending:
+            return modified_files
+
+        logger.info(f"Submitting {len(pending)} requests to the batch API")
+        messages = {custom_id: message for custom_id, (_, message) in pending.items()}
+        if self.provider == "anthropic":
+            responses = self._call_anthropic_batch_api(SYSTEM_PROMPT, messages)
+        else:  # default to OpenAI
+            responses = self._call_openai_batch_api(SYSTEM_PROMPT, messages)
+
+        for custom_id, (response, complete) in responses.items():
+            result = self._map_file_ids(
+                self._extract_modified_files(response), shard_files[custom_id]
+            )
+            if self.cache and result and complete:
+                self.cache.set(pending[custom_id][0], result)
+            modified_files.update(result)
+
+        return modified_files
+
+    def _build_shards(
+        self,
+        files_dict: dict[str, str],
+        file_groups: Optional[list[list[str]]],
+        prompt: str,
+    ) -> list[list[list[str]]]:
+        """
+        Bin-pack groups of related files into shards, one shard per request
+
+        A shard holds at most rows_per_call files and SHARD_TOKEN_BUDGET tokens.
+        Groups are kept whole, so a group exceeding either limit gets a shard
+        of its own, unless it doesn't fit in the model's context window at all.
+        """
+        if file_groups is None:
+            file_groups = [list(files_dict.keys())]
+
+        groups = [
+            [path for path in group if path in files_dict] for group in file_groups
+        ]
+        groups = [group for group in groups if group]
+
+        # Count what is actually sent, as JSON escaping adds tokens to every newline
+        # and quote. Ids are assigned per shard, so the global index is an upper bound.
+        paths = [path for group in groups for path in group]
+        file_tokens = {
+            path: self._count_tokens(
+                json.dumps(self._file_entry(index, path, files_dict[path]), indent=2)
+            )
+            for index, path in enumerate(paths)
+        }
+        context_budget = (
+            CONTEXT_WINDOWS[self.model]
+            - self._count_tokens(SYSTEM_PROMPT)
+            - self._count_tokens(self._build_user_message({}, prompt))
+            - RESERVED_OUTPUT_TOKENS
+        )
+        groups = self._split_oversized_groups(groups, file_tokens, context_budget)
+
+        shards: list[list[list[str]]] = []
+        shard_rows: list[int] = []
+        shard_tokens: list[int] = []
+        for group in groups:
+            tokens = sum(file_tokens[path] for path in group)
+            for index in range(len(shards)):
+                if (
+                    shard_rows[index] + len(group) <= self.rows_per_call
+                    and shard_tokens[index] + tokens <= SHARD_TOKEN_BUDGET
+                ):
+                    shards[index].append(group)
+                    shard_rows[index] += len(group)
+                    shard_tokens[index] += tokens
+                    break
+            else:
+                shards.append([group])
+                shard_rows.append(len(group))
+                shard_tokens.append(tokens)
+
+        return shards
+
+    def _split_oversized_groups(
+        self,
+        groups: list[list[str]],
+        file_tokens: dict[str, int],
+        context_budget: int,
+    ) -> list[list[str]]:
+        """Split groups that don't fit in the context window into several groups"""
+        result = []
+        for group in groups:
+            if sum(file_tokens[path] for path in group) <= context_budget:
+                result.append(group)
+                continue
+
+            logger.warning(
+                f"Group of {len(group)} related files exceeds the context window, splitting it"
+            )
+            # Greedily pack the files, rolling the overflow into additional groups
+            current: list[str] = []
+            current_tokens = 0
+            for path in group:
+                if current and current_tokens + file_tokens[path] > context_budget:
+                    result.append(current)
+                    current, current_tokens = [], 0
+                current.append(path)
+                current_tokens += file_tokens[path]
+            result.append(current)
+        return result
+
+    def _shard_files(
+        self, shard: list[list[str]], files_dict: dict[str, str]
+    ) -> dict[str, str]:
+        """Collect the contents of all files in a shard"""
+        return {path: files_dict[path] for group in shard for path in group}
+
+    async def warm_up(self) -> None:
+        """Load the tokenizer and create the API client ahead of the first request"""
+        try:
+            # Importing the SDK and loading the encoding are slow, so do both off the loop
+            await asyncio.gather(
+                asyncio.to_thread(
+                    importlib.import_module,
+                    "anthropic" if self.provider == "anthropic" else "openai",
+                ),
+                asyncio.to_thread(self._count_tokens, ""),
+            )
+            self._get_async_client()
+        except ImportError:
+            # A missing SDK is reported when the first request is made
+            pass
+
+    def _get_client(self) -> Any:
+        """Return the shared synchronous API client, creating it on first use"""
+        if self._client is None:
+            if self.provider == "anthropic":
+                import anthropic
+
+                self._client = anthropic.Anthropic(
+                    api_key=self.api_key,
+                    max_retries=self.max_retries,
+                    timeout=self.request_timeout,
+                )
+            else:  # default to OpenAI
+                import openai
+
+                self._client = openai.OpenAI(
+                    api_key=self.api_key,
+                    max_retries=self.max_retries,
+                    timeout=self.request_timeout,
+                )
+        return self._client
+
+    def _get_async_client(self) -> Any:
+        """
+        Return the shared async API client, creating it on first use
+
+        Async connections belong to the event loop they were opened on, so a
+        client left over from an earlier asyncio.run call is replaced.
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client_loop is not loop:
+            import httpx
+
+            http_options: dict[str, Any] = {
+                "limits": httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                ),
+                # HTTP/2 needs the optional h2 package
+                "http2": importlib.util.find_spec("h2") is not None,
+            }
+            if self.provider == "anthropic":
+                import anthropic
+
+                self._async_client = anthropic.AsyncAnthropic(
+                    api_key=self.api_key,
+                    max_retries=self.max_retries,
+                    timeout=self.request_timeout,
+                    http_client=anthropic.DefaultAsyncHttpxClient(**http_options),
+                )
+            else:  # default to OpenAI
+                import openai
+
+                self._async_client = openai.AsyncOpenAI(
+                    api_key=self.api_key,
+                    max_retries=self.max_retries,
+                    timeout=self.request_timeout,
+                    http_client=openai.DefaultAsyncHttpxClient(**http_options),
+                )
+            self._async_client_loop = loop
+        return self._async_client
+
+    def _max_output_tokens(self, system_prompt: str, user_message: str) -> int:
+        """Size the completion limit to whatever the context window has left"""
+        input_tokens = self._count_tokens(system_prompt) + self._count_tokens(
+            user_message
+        )
+        return max(
+            1,
+            min(
+                MAX_OUTPUT_TOKENS[self.model],
+                CONTEXT_WINDOWS[self.model] - input_tokens - 128,
+            ),
+        )
+
+    def _count_tokens(self, text: str) -> int:
+        """Count the tokens in a piece of text, estimating if tiktoken is unavailable"""
+        if self._encoding is None and not self._tiktoken_unavailable:
+            try:
+                import tiktoken
+
+                self._encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+            except ImportError:
+                logger.warning(
+                    "tiktoken library not available, estimating token counts. Install with: pip install tiktoken"
+                )
+                self._tiktoken_unavailable = True
+            except Exception as e:
+                logger.warning(f"Error loading tiktoken encoding: {str(e)}")
+                self._tiktoken_unavailable = True
+
+        if self._encoding is None:
+            return len(text) // 4
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def _cache_key(self, files_dict: dict[str, str], prompt: str) -> str:
+        """Build the response cache key for a request"""
+        return LLMCache.make_key(
+            version=PROMPT_VERSION,
+            provider=self.provider,
+            model=self.model,
+            sys=SYSTEM_PROMPT,
+            files=files_dict,
+            prompt=prompt,
+        )
+
+    def _build_user_message(self, files_dict: dict[str, str], prompt: str) -> str:
+        """Build the user message containing the prompt and file contents"""
+        # Give every file a short id so the response can be keyed by it
+        files = [
+            self._file_entry(index, file_path, content)
+            for index, (file_path, content) in enumerate(files_dict.items())
+        ]
 
         # Construct the full prompt
-        user_message = f"""
+        return f"""
 USER REQUIREMENTS:
 {prompt}
 
 TERRAFORM FILES:
-{files_content}
+{json.dumps(files, indent=2)}
 
 Please analyze these files and make the necessary changes to fulfill the requirements.
-Return the modified files in JSON format where each key is the file path and each value is the complete modified content.
+Return a JSON object {{file_id: modified_content}} where each key is the id of a file above and each value is its complete modified content.
 Only return the files that you've modified - don't include unchanged files.
 """
 
+    def _file_entry(self, index: int, file_path: str, content: str) -> dict[str, str]:
+        """Build the entry for a single file in the user message"""
+        return {"id": f"file_{index}", "path": file_path, "content": content}
+
+    def _map_file_ids(
+        self, modified_files: dict[str, str], files_dict: dict[str, str]
+    ) -> dict[str, str]:
+        """Map the file ids used in a response back to file paths"""
+        paths = {f"file_{index}": path for index, path in enumerate(files_dict)}
+
+        result = {}
+        for key, content in modified_files.items():
+            if key in paths:
+                result[paths[key]] = content
+            else:
+                if key not in files_dict:
+                    logger.warning(f"LLM returned a file that was not sent: {key}")
+                result[key] = content
+        return result
+
+    async def _update_shard(
+        self,
+        shard: list[list[str]],
+        files_dict: dict[str, str],
+        prompt: str,
+        semaphore: asyncio.Semaphore,
+        on_file: Optional[FileCallback] = None,
+    ) -> dict[str, str]:
+        """Update a single shard of files, using the cache when possible"""
+        shard_files = self._shard_files(shard, files_dict)
+        emitted: dict[str, str] = {}
+
+        async def emit(modified_files: dict[str, str]) -> None:
+            """Pass on files that haven't been passed to on_file in this form yet"""
+            if on_file is None:
+                return
+            for file_path, content in modified_files.items():
+                if emitted.get(file_path) != content:
+                    emitted[file_path] = content
+                    await on_file(file_path, content)
+
+        async def emit_streamed(file_id: str, content: str) -> None:
+            """Pass on a file completed while the response is still streaming"""
+            await emit(self._map_file_ids({file_id: content}, shard_files))
+
+        # Reuse a previous response for the exact same request if we have one
+        cache_key = self._cache_key(shard_files, prompt)
+        if self.cache:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Using cached LLM response for {len(cached)} files")
+                await emit(cached)
+                return cached
+
+        user_message = self._build_user_message(shard_files, prompt)
+
+        # The SDKs retry timeouts themselves, so a shard that can still be split
+        # only gets one attempt's worth of time before it is retried in halves
+        deadline = self.request_timeout if len(shard) > 1 else None
+
         # Determine which API to use
-        if self.provider == "anthropic":
-            return self._call_anthropic_api(system_prompt, user_message)
-        else:  # default to OpenAI
-            return self._call_openai_api(system_prompt, user_message)
+        try:
+            async with semaphore:
+                if self.provider == "anthropic":
+                    response_files, complete = await asyncio.wait_for(
+                        self._call_with_hedging(
+                            lambda on_start: self._call_anthropic_api_async(
+                                SYSTEM_PROMPT, user_message
+                            ),
+                            user_message,
+                        ),
+                        deadline,
+                    )
+                elif on_file:
+                    # Streamed requests are only raced until one starts streaming.
+                    # The timeout applies between chunks, so no overall deadline is set.
+                    response_files, complete = await self._call_with_hedging(
+                        lambda on_start: self._call_openai_api_async(
+                            SYSTEM_PROMPT,
+                            user_message,
+                            on_file=emit_streamed,
+                            on_start=on_start,
+                        ),
+                        user_message,
+                    )
+                else:  # default to OpenAI
+                    response_files, complete = await asyncio.wait_for(
+                        self._call_with_hedging(
+                            lambda on_start: self._call_openai_api_async(
+                                SYSTEM_PROMPT, user_message
+                            ),
+                            user_message,
+                        ),
+                        deadline,
+                    )
+        except (LLMTimeoutError, asyncio.TimeoutError):
+            if len(shard) == 1:
+                logger.error(f"LLM request for {len(shard_files)} files timed out")
+                return {}
+
+            # Pack fewer files per request from now on and retry this shard in halves.
+            # Concurrent timeouts must not compound, so size it from this shard.
+            self.rows_per_call = min(self.rows_per_call, max(1, len(shard_files) // 2))
+            logger.warning(
+                f"LLM request timed out, reducing rows_per_call to {self.rows_per_call}"
+            )
+            middle = len(shard) // 2
+            results = await asyncio.gather(
+                self._update_shard(
+                    shard[:middle], files_dict, prompt, semaphore, on_file
+                ),
+                self._update_shard(
+                    shard[middle:], files_dict, prompt, semaphore, on_file
+                ),
+            )
+            return {**results[0], **results[1]}
+        except LLMRequestError:
+            # The error has already been logged, and a failed request isn't cached
+            return {}
+
+        modified_files = self._map_file_ids(response_files, shard_files)
+        await emit(modified_files)
+
+        # A truncated response may be missing files, so only cache complete responses
+        if self.cache and modified_files and complete:
+            self.cache.set(cache_key, modified_files)
+
+        return modified_files
+
+    async def _call_with_hedging(
+        self,
+        call: Callable[[Callable[[], None]], Awaitable[tuple[dict[str, str], bool]]],
+        user_message: str,
+    ) -> tuple[dict[str, str], bool]:
+        """
+        Run an API call, hedging it with a duplicate if it is slow
+
+        If the call hasn't finished after hedge_delay seconds an identical
+        request is started, the first one to succeed is used and the other is
+        cancelled. This trades some extra token spend for a much shorter tail
+        latency. Hedging is disabled when hedge_delay is not set.
 
-    def _call_openai_api(self, system_prompt: str, user_message: str) -> dict[str, str]:
-        """Call OpenAI API to generate code updates"""
+        The call must raise on failure, so that a request that failed quickly
+        is never taken over one that is still running. It is passed an
+        on_start callback to invoke before it passes on any output, such as
+        the first chunk of a streamed response. That request is then used
+        whatever its outcome and the other one is cancelled straight away, so
+        only one of them ever produces output. The user message is only used
+        to estimate what the cancelled request may have cost.
+        """
+        started: asyncio.Future = asyncio.get_running_loop().create_future()
+        tasks: list[asyncio.Future] = []
+
+        def cancel_others(winner: asyncio.Future) -> None:
+            """Cancel every request except the one being used"""
+            for other in tasks:
+                if other is not winner and not other.done():
+                    other.cancel()
+                    # The provider may have already billed work for the cancelled
+                    # request, and its usage is never reported back to us
+                    input_tokens = self._count_tokens(SYSTEM_PROMPT + user_message)
+                    logger.warning(
+                        f"Cancelled the slower hedged LLM request, up to {input_tokens} input tokens "
+                        "and any output generated so far may be billed without being logged"
+                    )
+
+        def launch() -> None:
+            """Start another request"""
+
+            def on_start() -> None:
+                if not started.done():
+                    started.set_result(task)
+                    cancel_others(task)
+
+            task = asyncio.ensure_future(call(on_start))
+            tasks.append(task)
+
+        launch()
+        try:
+            pending = set(tasks)
+            timeout = self.hedge_delay or None
+            while True:
+                done, _ = await asyncio.wait(
+                    pending | {started},
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if started.done():
+                    return await started.result()
+
+                finished = {task for task in pending if task.done()}
+                for task in finished:
+                    if task.exception() is None:
+                        cancel_others(task)
+                        return task.result()
+                pending -= finished
+
+                if not done:
+                    logger.warning(
+                        f"LLM request still running after {self.hedge_delay}s, sending a hedged duplicate request"
+                    )
+                    launch()
+                    pending.add(tasks[-1])
+                    timeout = None
+                elif not pending:
+                    # Every request failed, report the error from the original one
+                    return tasks[0].result()
+        finally:
+            # asyncio.wait doesn't cancel the requests if we are cancelled ourselves
+            for task in tasks:
+                task.cancel()
+
+    async def _call_openai_api_async(
+        self,
+        system_prompt: str,
+        user_message: str,
+        on_file: Optional[FileCallback] = None,
+        on_start: Optional[Callable[[], None]] = None,
+    ) -> tuple[dict[str, str], bool]:
+        """
+        Call OpenAI API to generate code updates
+
+        When on_file is given the response is streamed and each file is passed
+        to it as soon as its JSON value has been received in full. on_start is
+        called when the first content of the streamed response arrives.
+
+        Returns:
+            The modified files and whether the response was complete rather
+            than cut off by the token limit
+        """
         try:
             import openai
 
-            client = openai.OpenAI(api_key=self.api_key)
+            client = self._get_async_client()
+
+            messages = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message},
+            ]
+            max_tokens = self._max_output_tokens(system_prompt, user_message)
+
+            if on_file is None:
+                response = await client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                )
+                logger.info(
+                    f"OpenAI usage: {response.usage.prompt_tokens} prompt tokens, "
+                    f"{response.usage.completion_tokens} completion tokens"
+                )
+                result = response.choices[0].message.content
+                complete = self._check_finish_reason(response.choices[0].finish_reason)
+                return self._extract_modified_files(result), complete
 
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message},
-                ],
-                max_tokens=8000,
+            stream = await client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                stream=True,
             )
+            parser = StreamingJSONParser()
+            streamed: dict[str, str] = {}
+            finish_reason = None
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                if not chunk.choices[0].delta.content:
+                    continue
+                if on_start is not None:
+                    on_start()
+                    on_start = None
+                for file_id, content in parser.feed(chunk.choices[0].delta.content):
+                    streamed[file_id] = content
+                    await on_file(file_id, content)
+            for file_id, content in parser.close():
+                streamed[file_id] = content
+                await on_file(file_id, content)
 
-            result = response.choices[0].message.content
-            return self._extract_modified_files(result)
+            # The full text is still parsed so that nothing the stream missed is lost
+            complete = self._check_finish_reason(finish_reason)
+            return {**streamed, **self._extract_modified_files(parser.text)}, complete
 
-        except ImportError:
+        except ImportError as e:
             logger.error(
                 "OpenAI library not available. Install with: pip install openai"
             )
-            return {}
+            raise LLMRequestError(str(e)) from e
+        except openai.APITimeoutError as e:
+            raise LLMTimeoutError(str(e)) from e
         except Exception as e:
             logger.error(f"Error calling OpenAI API: {str(e)}")
-            return {}
+            raise LLMRequestError(str(e)) from e
 
-    def _call_anthropic_api(
+    async def _call_anthropic_api_async(
         self, system_prompt: str, user_message: str
-    ) -> dict[str, str]:
-        """Call Anthropic API to generate code updates"""
+    ) -> tuple[dict[str, str], bool]:
+        """Call Anthropic API to generate code updates and report whether the response was complete"""
         try:
             import anthropic
 
-            client = anthropic.Anthropic(api_key=self.api_key)
+            client = self._get_async_client()
 
-            response = client.messages.create(
-                model="claude-3-7-sonnet-20250219",
+            response = await client.messages.create(
+                model=self.model,
                 system=system_prompt,
-                max_tokens=8000,
+                max_tokens=self._max_output_tokens(system_prompt, user_message),
                 messages=[{"role": "user", "content": user_message}],
             )
 
+            logger.info(
+                f"Anthropic usage: {response.usage.input_tokens} input tokens, "
+                f"{response.usage.output_tokens} output tokens"
+            )
             result = response.content[0].text
-            return self._extract_modified_files(result)
+            complete = self._check_stop_reason(response.stop_reason)
+            return self._extract_modified_files(result), complete
+
+        except ImportError as e:
+            logger.error(
+                "Anthropic library not available. Install with: pip install anthropic"
+            )
+            raise LLMRequestError(str(e)) from e
+        except anthropic.APITimeoutError as e:
+            raise LLMTimeoutError(str(e)) from e
+        except Exception as e:
+            logger.error(f"Error calling Anthropic API: {str(e)}")
+            raise LLMRequestError(str(e)) from e
+
+    def _call_openai_batch_api(
+        self, system_prompt: str, messages: dict[str, str]
+    ) -> dict[str, tuple[str, bool]]:
+        """Run requests through the OpenAI Batch API and return raw responses and completeness by ID"""
+        try:
+            client = self._get_client()
+
+            lines = [
+                json.dumps(
+                    {
+                        "custom_id": custom_id,
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": {
+                            "model": self.model,
+                            "messages": [
+                                {"role": "system", "content": system_prompt},
+                                {"role": "user", "content": user_message},
+                            ],
+                            "max_tokens": self._max_output_tokens(
+                                system_prompt, user_message
+                            ),
+                        },
+                    }
+                )
+                for custom_id, user_message in messages.items()
+            ]
+            batch_file = client.files.create(
+                file=("batch.jsonl", "\n".join(lines).encode()), purpose="batch"
+            )
+            batch = client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+            logger.info(f"Created OpenAI batch {batch.id}")
+
+            batch = self._wait_for_batch(
+                lambda: client.batches.retrieve(batch.id),
+                lambda b: b.status in ("completed", "failed", "expired", "cancelled"),
+            )
+            if batch.status != "completed" or not batch.output_file_id:
+                logger.error(f"OpenAI batch {batch.id} finished as {batch.status}")
+                return {}
+
+            responses = {}
+            output = client.files.content(batch.output_file_id).text
+            for line in output.splitlines():
+                item = json.loads(line)
+                response = item.get("response") or {}
+                if response.get("status_code") != 200:
+                    logger.error(f"Batch request {item['custom_id']} failed")
+                    continue
+                choice = response["body"]["choices"][0]
+                responses[item["custom_id"]] = (
+                    choice["message"]["content"],
+                    self._check_finish_reason(choice.get("finish_reason")),
+                )
+            return responses
+
+        except ImportError:
+            logger.error(
+                "OpenAI library not available. Install with: pip install openai"
+            )
+            return {}
+        except Exception as e:
+            logger.error(f"Error calling OpenAI Batch API: {str(e)}")
+            return {}
+
+    def _call_anthropic_batch_api(
+        self, system_prompt: str, messages: dict[str, str]
+    ) -> dict[str, tuple[str, bool]]:
+        """Run requests through the Anthropic Message Batches API and return raw responses and completeness by ID"""
+        try:
+            client = self._get_client()
+
+            batch = client.messages.batches.create(
+                requests=[
+                    {
+                        "custom_id": custom_id,
+                        "params": {
+                            "model": self.model,
+                            "system": system_prompt,
+                            "max_tokens": self._max_output_tokens(
+                                system_prompt, user_message
+                            ),
+                            "messages": [{"role": "user", "content": user_message}],
+                        },
+                    }
+                    for custom_id, user_message in messages.items()
+                ]
+            )
+            logger.info(f"Created Anthropic message batch {batch.id}")
+
+            self._wait_for_batch(
+                lambda: client.messages.batches.retrieve(batch.id),
+                lambda b: b.processing_status == "ended",
+            )
+
+            responses = {}
+            for item in client.messages.batches.results(batch.id):
+                if item.result.type != "succeeded":
+                    logger.error(
+                        f"Batch request {item.custom_id} finished as {item.result.type}"
+                    )
+                    continue
+                message = item.result.message
+                responses[item.custom_id] = (
+                    message.content[0].text,
+                    self._check_stop_reason(message.stop_reason),
+                )
+            return responses
 
         except ImportError:
             logger.error(
@@ -127,9 +919,40 @@ Only return the files that you've modified - don't include unchanged files.
             )
             return {}
         except Exception as e:
-            logger.error(f"Error calling Anthropic API: {str(e)}")
+            logger.error(f"Error calling Anthropic Message Batches API: {str(e)}")
             return {}
 
+    def _check_finish_reason(self, finish_reason: Optional[str]) -> bool:
+        """Check whether an OpenAI response ran to completion"""
+        if finish_reason == "stop":
+            return True
+        logger.warning(
+            f"OpenAI response ended with finish_reason {finish_reason}, it may be truncated and won't be cached"
+        )
+        return False
+
+    def _check_stop_reason(self, stop_reason: Optional[str]) -> bool:
+        """Check whether an Anthropic response ran to completion"""
+        if stop_reason != "max_tokens":
+            return True
+        logger.warning(
+            "Anthropic response hit the max_tokens limit, it may be truncated and won't be cached"
+        )
+        return False
+
+    def _wait_for_batch(
+        self, retrieve: Callable[[], Any], is_done: Callable[[Any], bool]
+    ) -> Any:
+        """Poll a batch with exponential backoff until it has finished"""
+        delay = BATCH_POLL_INITIAL_S
+        batch = retrieve()
+        while not is_done(batch):
+            logger.info(f"Batch still running, checking again in {delay}s")
+            time.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_S)
+            batch = retrieve()
+        return batch
+
     def _extract_modified_files(self, response: str) -> dict[str, str]:
         """Extract modified files from the LLM response"""
         try:
@@ -137,24 +960,58 @@ Only return the files that you've modified - don't include unchanged files.
             json_match = re.search(r"```json\s*([\s\S]*?)\s*```", response)
             if json_match:
                 json_str = json_match.group(1)
-                modified_files = json.loads(json_str)
+                modified_files = self._normalize_modified_files(orjson.loads(json_str))
                 logger.info(
                     f"Extracted {len(modified_files)} modified files from JSON response"
                 )
                 return modified_files
             else:
                 # If no JSON block is found, try to parse the entire response
-                modified_files = json.loads(response)
+                modified_files = self._normalize_modified_files(orjson.loads(response))
                 logger.info(
                     f"Extracted {len(modified_files)} modified files from direct JSON response"
                 )
                 return modified_files
 
-        except json.JSONDecodeError:
+        except (orjson.JSONDecodeError, json.JSONDecodeError):
             logger.error("Failed to parse JSON from LLM response")
             # If JSON parsing fails, try to extract file sections manually
             return self._extract_files_manually(response)
 
+    def _normalize_modified_files(self, data: Any) -> dict[str, str]:
+        """
+        Convert parsed JSON from the LLM into a mapping of file ids to contents
+
+        The files are sent as a list of {id, path, content} rows, so the model
+        may answer in that shape instead of the {id: content} object asked for.
+        Entries whose content isn't a string are dropped, and any other shape
+        is treated as a failed response.
+        """
+        if isinstance(data, list):
+            rows, data = data, {}
+            for row in rows:
+                key = (
+                    row.get("id") or row.get("path") if isinstance(row, dict) else None
+                )
+                if isinstance(key, str):
+                    data[key] = row.get("content")
+        if not isinstance(data, dict):
+            logger.error(
+                f"Unexpected JSON in LLM response: {type(data).__name__} instead of an object"
+            )
+            return {}
+
+        modified_files = {
+            key: content
+            for key, content in data.items()
+            if isinstance(key, str) and isinstance(content, str)
+        }
+        if len(modified_files) < len(data):
+            logger.warning(
+                f"Ignoring {len(data) - len(modified_files)} files without string content in LLM response"
+            )
+        return modified_files
+
     def _extract_files_manually(self, text: str) -> dict[str, str]:
         """Extract file contents manually from text if JSON parsing fails"""
         files = {}
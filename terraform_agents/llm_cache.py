@@ -0,0 +1,77 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+from typing import Any
+from typing import Optional
+
+
+logger = logging.getLogger("terraform-agent")
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".terraform_agent", "llm_cache"
+)
+DEFAULT_EXPIRE = 7 * 86400
+
+
+class LLMCache:
+    """Persistent SQLite-backed cache for LLM responses keyed by content hash"""
+
+    def __init__(
+        self, cache_dir: str = DEFAULT_CACHE_DIR, expire: int = DEFAULT_EXPIRE
+    ):
+        """Initialize the cache database in the given directory"""
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, "cache.db")
+        self.expire = expire
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            # Expired rows are never read again, so drop them to keep the database small
+            conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a new connection to the cache database"""
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    @staticmethod
+    def make_key(**parts: Any) -> str:
+        """Build a stable SHA-256 key from the given request parts"""
+        payload = json.dumps(parts, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict[str, str]]:
+        """Return the cached value for a key, or None if missing or expired"""
+        try:
+            with closing(self._connect()) as conn:
+                row = conn.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Error reading LLM cache: {str(e)}")
+            return None
+
+        if row is None or row[1] < time.time():
+            return None
+        try:
+            return json.loads(row[0])
+        except ValueError as e:
+            logger.warning(f"Ignoring corrupt LLM cache entry: {str(e)}")
+            return None
+
+    def set(self, key: str, value: dict[str, str]) -> None:
+        """Store a value under a key until the cache expiry elapses"""
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), time.time() + self.expire),
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Error writing LLM cache: {str(e)}")
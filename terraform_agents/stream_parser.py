@@ -0,0 +1,113 @@
+import logging
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+logger = logging.getLogger("terraform-agent")
+
+JSON_FENCE = "```json"
+# JSON strings can't contain a raw newline, so this only matches the real closing fence
+CLOSING_FENCE = "\n```"
+
+
+class StreamingJSONParser:
+    """Incrementally parses a streamed JSON object of file contents"""
+
+    def __init__(self):
+        """Initialize an empty parser"""
+        self.text = ""
+        self._chunks: list[str] = []
+        # Text received after the start of the JSON object that hasn't been parsed yet
+        self._pending = ""
+        self._started = False
+        self._finished = False
+        self._events = None
+        self._coro = None
+
+        if ijson is not None:
+            self._events = ijson.sendable_list()
+            self._coro = ijson.kvitems_coro(self._events, "")
+        else:
+            logger.warning(
+                "ijson library not available, files will be parsed once the response completes. "
+                "Install with: pip install ijson"
+            )
+
+    def feed(self, chunk: str) -> list[tuple[str, str]]:
+        """
+        Feed the next chunk of the response
+
+        Args:
+            chunk: Next piece of text from the streamed response
+
+        Returns:
+            List of (key, content) pairs that were completed by this chunk
+        """
+        # Joined once in close(), as appending to one string would be quadratic
+        self._chunks.append(chunk)
+        if self._coro is None or self._finished:
+            return []
+
+        self._pending += chunk
+
+        # Wait until we know where the JSON object starts
+        if not self._started:
+            fence = self._pending.find(JSON_FENCE)
+            if fence >= 0:
+                start = fence + len(JSON_FENCE)
+                self._pending = self._pending[start:]
+            elif self._pending.lstrip().startswith("{"):
+                self._pending = self._pending.lstrip()
+            else:
+                return []
+            self._started = True
+
+        closing = self._pending.find(CLOSING_FENCE)
+        if closing >= 0:
+            data = self._pending[:closing]
+            self._pending = ""
+            self._finished = True
+        elif len(self._pending) > len(CLOSING_FENCE):
+            # Hold back a few characters in case they start the closing fence
+            split = len(self._pending) - len(CLOSING_FENCE)
+            data, self._pending = self._pending[:split], self._pending[split:]
+        else:
+            return []
+
+        return self._send(data)
+
+    def close(self) -> list[tuple[str, str]]:
+        """Finish parsing, making the full response available as text, and return any remaining (key, content) pairs"""
+        self.text = "".join(self._chunks)
+        if self._coro is None:
+            return []
+
+        items = []
+        if self._started and not self._finished:
+            items = self._send(self._pending)
+            self._pending = ""
+
+        if self._coro is not None:
+            try:
+                self._coro.close()
+            except ijson.JSONError as e:
+                logger.debug(f"Streamed JSON response was incomplete: {str(e)}")
+            self._coro = None
+        return items
+
+    def _send(self, data: str) -> list[tuple[str, str]]:
+        """Send data to the underlying ijson parser and collect completed pairs"""
+        try:
+            self._coro.send(data.encode())
+        except ijson.JSONError as e:
+            # Leave it to the caller to parse the full text once the stream ends
+            logger.debug(f"Could not parse streamed JSON response: {str(e)}")
+            self._coro = None
+            return []
+
+        items = [(key, value) for key, value in self._events if isinstance(value, str)]
+        del self._events[:]
+        return items
@@ -1,12 +1,101 @@
 import logging
 import os
 import re
-from pathlib import Path
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 from typing import Optional
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 
 logger = logging.getLogger("terraform-agent")
 
+# Patterns are compiled once and shared by every analyzer instance
+_MOD_RE = re.compile(
+    r'module\s+["\']([\w-]+)["\']\s*{[^}]*source\s*=\s*["\']([\w\.\/-]+)["\']'
+)
+_VAR_REF_RE = re.compile(r"var\.([a-zA-Z0-9_-]+)")
+_VAR_DECL_RE = re.compile(r'variable\s+"([a-zA-Z0-9_-]+)"')
+
+# Common Terraform resource types and concepts to look for in prompts
+_TF_KEYWORDS = (
+    "vpc",
+    "subnet",
+    "security_group",
+    "nacl",
+    "sg",
+    "security",
+    "network",
+    "flow_log",
+    "encryption",
+    "firewall",
+    "route",
+    "gateway",
+    "iam",
+    "policy",
+    "ec2",
+    "rds",
+    "lambda",
+    "s3",
+    "kms",
+    "ssl",
+    "tls",
+    "https",
+    "alb",
+    "elb",
+    "load_balancer",
+    "autoscaling",
+    "cloudwatch",
+    "logs",
+    "cloudtrail",
+    "monitoring",
+    "alerts",
+    "backup",
+    "storage",
+)
+_VPC_KEYWORDS = ("vpc", "subnet", "cidr", "network", "route", "gateway")
+_IMPORTANT_FILES = ("main.tf", "variables.tf", "outputs.tf")
+_STOP_WORDS = frozenset(
+    {
+        "update",
+        "the",
+        "by",
+        "adding",
+        "and",
+        "or",
+        "with",
+        "for",
+        "to",
+        "in",
+        "on",
+        "a",
+        "an",
+        "this",
+        "that",
+        "these",
+        "those",
+        "our",
+        "your",
+        "my",
+        "mine",
+        "we",
+        "need",
+        "want",
+        "should",
+        "will",
+    }
+)
+_WORD_RE = re.compile(r"\b\w{3,}\b")
+
+MAX_READ_WORKERS = 32
+
+# Terraform files larger than this are almost always generated, so skip them
+MAX_TF_SIZE = 256 * 1024
+
 
 class TerraformAnalyzer:
     """Analyzes Terraform code to find relevant files and relationships"""
@@ -15,29 +104,82 @@ class TerraformAnalyzer:
         """Initialize with repository path"""
         self.repo_path = repo_path
         self.file_contents: dict[str, str] = {}
-        self.dependency_graph: dict[str, list[str]] = {}
+        self.dependency_graph: dict[str, set[str]] = {}
+        self.var_decl_index: dict[str, list[str]] = {}
+        self._content_lower: dict[str, str] = {}
+        self._deps_closure: dict[str, frozenset[str]] = {}
         self._load_terraform_files()
 
     def _load_terraform_files(self) -> None:
         """Load all Terraform files from the repository"""
-        terraform_files = list(Path(self.repo_path).glob("**/*.tf"))
+        terraform_files = []
+        for root, dirs, files in os.walk(self.repo_path):
+            # Skip provider caches and sort in place so files are always visited in the same order
+            dirs[:] = sorted(d for d in dirs if d != ".terraform")
+            for name in sorted(files):
+                if not name.endswith(".tf"):
+                    continue
+                file_path = os.path.join(root, name)
+                if self._is_excluded(os.path.relpath(file_path, self.repo_path)):
+                    logger.debug(f"Skipping module example file: {file_path}")
+                    continue
+                try:
+                    file_size = os.path.getsize(file_path)
+                except OSError as e:
+                    logger.error(f"Error reading file {file_path}: {str(e)}")
+                    continue
+                if file_size > MAX_TF_SIZE:
+                    logger.warning(
+                        f"Skipping {file_path}: {file_size} bytes is larger than {MAX_TF_SIZE}"
+                    )
+                    continue
+                terraform_files.append(file_path)
         logger.info(f"Found {len(terraform_files)} Terraform files in repository")
 
-        for file_path in terraform_files:
-            relative_path = str(file_path.relative_to(self.repo_path))
-            try:
-                file_content = file_path.read_text()
-                self.file_contents[relative_path] = file_content
-                self.dependency_graph[relative_path] = []
-                logger.debug(f"Loaded file: {relative_path}")
-            except Exception as e:
-                logger.error(f"Error reading file {file_path}: {str(e)}")
+        # Reads release the GIL, so a thread pool overlaps the file I/O
+        with ThreadPoolExecutor(max_workers=MAX_READ_WORKERS) as executor:
+            contents = list(executor.map(self._read_file, terraform_files))
+
+        for file_path, file_content in zip(terraform_files, contents):
+            if file_content is None:
+                continue
+            relative_path = os.path.relpath(file_path, self.repo_path)
+            self.file_contents[relative_path] = file_content
+            self._content_lower[relative_path] = file_content.lower()
+            self.dependency_graph[relative_path] = set()
+            logger.debug(f"Loaded file: {relative_path}")
+
+            # Index variable declarations so references can be resolved directly
+            for var_name in _VAR_DECL_RE.findall(file_content):
+                self.var_decl_index.setdefault(var_name, []).append(relative_path)
 
         # Find dependencies between files
         self._build_dependency_graph()
 
+    def _is_excluded(self, relative_path: str) -> bool:
+        """Check whether a file is an example shipped inside a module (modules/*/examples/)"""
+        parts = relative_path.split(os.sep)
+        return any(
+            part == "modules"
+            and index + 2 < len(parts)
+            and parts[index + 2] == "examples"
+            for index, part in enumerate(parts)
+        )
+
+    def _read_file(self, file_path: str) -> Optional[str]:
+        """Read a single file, returning None if it cannot be read"""
+        try:
+            with open(file_path) as f:
+                return f.read()
+        except Exception as e:
+            logger.error(f"Error reading file {file_path}: {str(e)}")
+            return None
+
     def _build_dependency_graph(self) -> None:
         """Build a simple dependency graph between Terraform files"""
+        # Cached dependency closures are only valid for the graph they were built from
+        self._deps_closure.clear()
+
         # Look for references between files
         for file_path, content in self.file_contents.items():
             # Look for module sources
@@ -57,71 +199,62 @@ class TerraformAnalyzer:
                     # Find all .tf files in this directory
                     for other_file in self.file_contents.keys():
                         if other_file.startswith(source_dir):
-                            self.dependency_graph[file_path].append(other_file)
+                            self.dependency_graph[file_path].add(other_file)
                             logger.debug(
                                 f"Added dependency: {file_path} -> {other_file}"
                             )
 
             # For each variable reference, find the corresponding variable declaration
             for var_name in var_refs:
-                for other_file, other_content in self.file_contents.items():
-                    if f'variable "{var_name}"' in other_content:
-                        self.dependency_graph[file_path].append(other_file)
-                        logger.debug(
-                            f"Added variable dependency: {file_path} -> {other_file}"
-                        )
+                for other_file in self.var_decl_index.get(var_name, []):
+                    self.dependency_graph[file_path].add(other_file)
+                    logger.debug(
+                        f"Added variable dependency: {file_path} -> {other_file}"
+                    )
 
     def _extract_module_sources(self, content: str) -> list[str]:
         """Extract module sources from Terraform content"""
-        sources = []
         # Look for module blocks and their sources
-        module_pattern = (
-            r'module\s+["\']([\w-]+)["\']\s*{[^}]*source\s*=\s*["\']([\w\.\/-]+)["\']'
-        )
-        for match in re.finditer(module_pattern, content):
-            sources.append(match.group(2))
-        return sources
+        return [match.group(2) for match in _MOD_RE.finditer(content)]
 
     def _extract_variable_references(self, content: str) -> list[str]:
         """Extract variable references from Terraform content"""
-        var_pattern = r"var\.([a-zA-Z0-9_-]+)"
-        matches = re.findall(var_pattern, content)
-        return list(set(matches))  # Return unique variable names
+        # Return unique variable names in the order they first appear
+        return list(dict.fromkeys(_VAR_REF_RE.findall(content)))
 
     def find_relevant_files(self, prompt: str) -> dict[str, str]:
         """Find files relevant to the user prompt"""
         relevant_files = {}
+        prompt_lower = prompt.lower()
 
         # Extract keywords from the prompt
-        keywords = self._extract_keywords_from_prompt(prompt)
+        keywords = self._extract_keywords_from_prompt(prompt_lower)
         logger.info(f"Extracted keywords from prompt: {keywords}")
 
         # First pass: find files with direct keyword references
-        for file_path, content in self.file_contents.items():
-            content_lower = content.lower()
-            if any(keyword in content_lower for keyword in keywords) or any(
-                keyword in file_path.lower() for keyword in keywords
-            ):
-                relevant_files[file_path] = content
+        matches_keyword = self._build_matcher(keywords)
+        for file_path, content_lower in self._content_lower.items():
+            if matches_keyword(content_lower) or matches_keyword(file_path.lower()):
+                relevant_files[file_path] = self.file_contents[file_path]
                 logger.debug(f"Found relevant file by keyword: {file_path}")
 
         # If the prompt mentions VPC specifically, also include VPC-related files
-        if any(vpc_term in prompt.lower() for vpc_term in ["vpc", "network"]):
-            vpc_keywords = ["vpc", "subnet", "cidr", "network", "route", "gateway"]
-            for file_path, content in self.file_contents.items():
+        needs_vpc = "vpc" in prompt_lower or "network" in prompt_lower
+        if needs_vpc:
+            matches_vpc_keyword = self._build_matcher(_VPC_KEYWORDS)
+            for file_path, content_lower in self._content_lower.items():
                 if file_path not in relevant_files:
-                    content_lower = content.lower()
-                    if any(keyword in content_lower for keyword in vpc_keywords) or any(
-                        keyword in file_path.lower() for keyword in vpc_keywords
+                    if matches_vpc_keyword(content_lower) or matches_vpc_keyword(
+                        file_path.lower()
                     ):
-                        relevant_files[file_path] = content
+                        relevant_files[file_path] = self.file_contents[file_path]
                         logger.debug(f"Found VPC-related file: {file_path}")
 
         # Second pass: add dependencies
         dependency_files = {}
         for file_path in list(relevant_files.keys()):
             dependencies = self._find_all_dependencies(file_path)
-            for dep in dependencies:
+            for dep in sorted(dependencies):
                 if dep not in relevant_files and dep in self.file_contents:
                     dependency_files[dep] = self.file_contents[dep]
                     logger.debug(f"Added dependency file: {dep}")
@@ -133,7 +266,7 @@ class TerraformAnalyzer:
         if len(relevant_files) < 3:
             for file_path, content in self.file_contents.items():
                 if file_path not in relevant_files and file_path.endswith(
-                    ("main.tf", "variables.tf", "outputs.tf")
+                    _IMPORTANT_FILES
                 ):
                     relevant_files[file_path] = content
                     logger.debug(f"Added important file: {file_path}")
@@ -141,106 +274,89 @@ class TerraformAnalyzer:
         logger.info(f"Found {len(relevant_files)} relevant files for prompt")
         return relevant_files
 
-    def _extract_keywords_from_prompt(self, prompt: str) -> list[str]:
-        """Extract relevant keywords from the user prompt"""
-        # Convert to lowercase
-        prompt_lower = prompt.lower()
-
-        # Define common Terraform resource types and concepts
-        terraform_keywords = [
-            "vpc",
-            "subnet",
-            "security_group",
-            "nacl",
-            "sg",
-            "security",
-            "network",
-            "flow_log",
-            "encryption",
-            "firewall",
-            "route",
-            "gateway",
-            "iam",
-            "policy",
-            "ec2",
-            "rds",
-            "lambda",
-            "s3",
-            "kms",
-            "ssl",
-            "tls",
-            "https",
-            "alb",
-            "elb",
-            "load_balancer",
-            "autoscaling",
-            "cloudwatch",
-            "logs",
-            "cloudtrail",
-            "monitoring",
-            "alerts",
-            "backup",
-            "storage",
-        ]
-
+    def group_files(self, file_paths: list[str]) -> list[list[str]]:
+        """Group files into connected components of the dependency graph"""
+        selected = set(file_paths)
+
+        # Treat dependencies as undirected edges between the selected files
+        neighbours: dict[str, set[str]] = {path: set() for path in selected}
+        for path in selected:
+            for dep in self.dependency_graph.get(path, ()):
+                if dep in selected and dep != path:
+                    neighbours[path].add(dep)
+                    neighbours[dep].add(path)
+
+        order = {path: index for index, path in enumerate(file_paths)}
+        groups = []
+        seen: set[str] = set()
+        for path in file_paths:
+            if path in seen:
+                continue
+            seen.add(path)
+            group, stack = [], [path]
+            while stack:
+                current = stack.pop()
+                group.append(current)
+                for other in neighbours[current]:
+                    if other not in seen:
+                        seen.add(other)
+                        stack.append(other)
+            # Keep the caller's file order so prompts are reproducible
+            group.sort(key=order.__getitem__)
+            groups.append(group)
+
+        logger.info(f"Split {len(file_paths)} files into {len(groups)} groups")
+        return groups
+
+    def _build_matcher(self, keywords: Sequence[str]) -> Callable[[str], bool]:
+        """Build a function that checks in a single pass whether text contains any keyword"""
+        if not keywords:
+            return lambda text: False
+
+        if ahocorasick is not None:
+            automaton = ahocorasick.Automaton()
+            for keyword in keywords:
+                automaton.add_word(keyword, keyword)
+            automaton.make_automaton()
+            return lambda text: next(automaton.iter(text), None) is not None
+
+        # Fall back to a single alternation regex, which still scans each text once
+        pattern = re.compile("|".join(map(re.escape, keywords)))
+        return lambda text: pattern.search(text) is not None
+
+    def _extract_keywords_from_prompt(self, prompt_lower: str) -> list[str]:
+        """Extract relevant keywords from the lowercased user prompt"""
         # Find terraform keywords in the prompt
-        found_keywords = []
-        for keyword in terraform_keywords:
-            if keyword in prompt_lower:
-                found_keywords.append(keyword)
+        found_keywords = [
+            keyword for keyword in _TF_KEYWORDS if keyword in prompt_lower
+        ]
 
         # If no specific keywords, extract all significant words
         if not found_keywords:
-            import re
-
-            stop_words = {
-                "update",
-                "the",
-                "by",
-                "adding",
-                "and",
-                "or",
-                "with",
-                "for",
-                "to",
-                "in",
-                "on",
-                "a",
-                "an",
-                "this",
-                "that",
-                "these",
-                "those",
-                "our",
-                "your",
-                "my",
-                "mine",
-                "we",
-                "need",
-                "want",
-                "should",
-                "will",
-            }
-            words = re.findall(r"\b\w{3,}\b", prompt_lower)
-            found_keywords = [word for word in words if word not in stop_words]
+            words = _WORD_RE.findall(prompt_lower)
+            found_keywords = [word for word in words if word not in _STOP_WORDS]
 
         return found_keywords
 
-    def _find_all_dependencies(
-        self, file_path: str, visited: Optional[set[str]] = None
-    ) -> list[str]:
-        """Find all dependencies of a file recursively"""
-        if visited is None:
-            visited = set()
-
-        if file_path in visited:
-            return []
-
-        visited.add(file_path)
-        dependencies = []
-
-        for dep in self.dependency_graph.get(file_path, []):
-            dependencies.append(dep)
-            dependencies.extend(self._find_all_dependencies(dep, visited))
-
-        return list(set(dependencies))  # Return unique dependencies
+    def _find_all_dependencies(self, file_path: str) -> frozenset[str]:
+        """Find all dependencies of a file, caching the result per file"""
+        if file_path in self._deps_closure:
+            return self._deps_closure[file_path]
+
+        # Iterative DFS so deep module graphs can't hit the recursion limit
+        dependencies: set[str] = set()
+        stack = [file_path]
+        while stack:
+            current = stack.pop()
+            for dep in self.dependency_graph.get(current, ()):
+                if dep in dependencies:
+                    continue
+                dependencies.add(dep)
+                # A cached closure already covers everything reachable from dep
+                if dep in self._deps_closure:
+                    dependencies.update(self._deps_closure[dep])
+                else:
+                    stack.append(dep)
+
+        self._deps_closure[file_path] = frozenset(dependencies)
+        return self._deps_closure[file_path]
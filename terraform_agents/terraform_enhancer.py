@@ -1,9 +1,16 @@
+import asyncio
 import logging
 import os
 from typing import Any
+from typing import Optional
 
 from terraform_agents.github_utils import GitHubRepo
+from terraform_agents.llm import DEFAULT_MAX_CONCURRENCY
+from terraform_agents.llm import DEFAULT_MAX_RETRIES
+from terraform_agents.llm import DEFAULT_REQUEST_TIMEOUT
+from terraform_agents.llm import DEFAULT_ROWS_PER_CALL
 from terraform_agents.llm import LLMClient
+from terraform_agents.llm_cache import DEFAULT_CACHE_DIR
 from terraform_agents.terraform_analyzer import TerraformAnalyzer
 
 
@@ -17,10 +24,19 @@ class TerraformEnhancer:
         """Initialize with configuration"""
         self.config = config
         self.llm_client = LLMClient(
-            api_key=config.get("api_key", ""), provider=config.get("provider", "openai")
+            api_key=config.get("api_key", ""),
+            provider=config.get("provider", "openai"),
+            cache_dir=config.get("cache_dir", DEFAULT_CACHE_DIR),
+            max_concurrency=config.get("max_concurrency", DEFAULT_MAX_CONCURRENCY),
+            rows_per_call=config.get("rows_per_call", DEFAULT_ROWS_PER_CALL),
+            max_retries=config.get("max_retries", DEFAULT_MAX_RETRIES),
+            hedge_delay=config.get("hedge_delay"),
+            request_timeout=config.get("request_timeout", DEFAULT_REQUEST_TIMEOUT),
         )
 
-    def enhance_terraform_code(self, repo_url: str, prompt: str) -> dict[str, str]:
+    async def enhance_terraform_code(
+        self, repo_url: str, prompt: str
+    ) -> dict[str, str]:
         """
         Enhance Terraform code based on user prompt
 
@@ -32,9 +48,11 @@ class TerraformEnhancer:
             Dictionary of modified files
         """
         try:
-            # Step 1: Clone the repository
+            # Step 1: Clone the repository, warming up the LLM client in the meantime
             github_repo = GitHubRepo(repo_url, token=self.config.get("github_token"))
-            repo_path = github_repo.clone()
+            repo_path, _ = await asyncio.gather(
+                github_repo.clone_async(), self.llm_client.warm_up()
+            )
             logger.info(f"Cloned repository to {repo_path}")
 
             # Step 2: Analyze the repository for dependencies
@@ -47,16 +65,28 @@ class TerraformEnhancer:
                 logger.warning("No relevant files found. Using all Terraform files.")
                 relevant_files = analyzer.file_contents
 
-            # Step 4: Use LLM to update the code
+            # Step 4: Use LLM to update the code, one request per group of related files
+            # Step 5: Save results, streaming files to disk as they are generated
             logger.info(f"Sending {len(relevant_files)} files to LLM for enhancement")
-            modified_files = self.llm_client.update_terraform_code(
-                relevant_files, prompt
-            )
-
-            # Step 5: Save results
-            if self.config.get("output_dir"):
-                self._save_results(
-                    modified_files, self.config.get("output_dir", "./output")
+            file_groups = analyzer.group_files(list(relevant_files.keys()))
+            output_dir = self.config.get("output_dir")
+            if self.config.get("mode") == "batch":
+                # Polling the batch blocks for a long time, so keep it off the event loop
+                modified_files = await asyncio.to_thread(
+                    self.llm_client.update_terraform_code_batch,
+                    relevant_files,
+                    prompt,
+                    file_groups=file_groups,
+                )
+                if output_dir:
+                    await self._save_results(modified_files, output_dir)
+            elif output_dir:
+                modified_files = await self._update_and_save(
+                    relevant_files, prompt, file_groups, output_dir
+                )
+            else:
+                modified_files = await self.llm_client.update_terraform_code_async(
+                    relevant_files, prompt, file_groups=file_groups
                 )
 
             # Step 6: Cleanup
@@ -68,15 +98,81 @@ class TerraformEnhancer:
             logger.error(f"Error enhancing Terraform code: {str(e)}")
             raise
 
-    def _save_results(self, modified_files: dict[str, str], output_dir: str) -> None:
-        """Save modified files to the output directory"""
-        os.makedirs(output_dir, exist_ok=True)
+    async def _update_and_save(
+        self,
+        relevant_files: dict[str, str],
+        prompt: str,
+        file_groups: list[list[str]],
+        output_dir: str,
+    ) -> dict[str, str]:
+        """Update the code with the LLM while saving each file as soon as it arrives"""
+        queue: asyncio.Queue = asyncio.Queue()
+        writer = asyncio.create_task(self._save_from_queue(queue, output_dir))
 
-        for file_path, content in modified_files.items():
-            output_path = os.path.join(output_dir, file_path)
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        async def on_file(file_path: str, content: str) -> None:
+            await queue.put((file_path, content))
 
-            with open(output_path, "w") as f:
-                f.write(content)
+        try:
+            return await self.llm_client.update_terraform_code_async(
+                relevant_files, prompt, file_groups=file_groups, on_file=on_file
+            )
+        finally:
+            await queue.put(None)
+            await writer
+
+    async def _save_from_queue(self, queue: asyncio.Queue, output_dir: str) -> None:
+        """Save files from the queue until a None sentinel is received"""
+        saved = set()
+        created_dirs: set[str] = set()
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            file_path, content = item
+            await self._save_one(file_path, content, output_dir, created_dirs)
+            saved.add(file_path)
+
+        logger.info(f"Saved {len(saved)} modified files to {output_dir}")
+
+    async def _save_one(
+        self, file_path: str, content: str, output_dir: str, created_dirs: set[str]
+    ) -> None:
+        """Save a single modified file, creating its directory on first use"""
+        output_path = os.path.join(output_dir, file_path)
+        directory = os.path.dirname(output_path)
+        new_directory = directory if directory not in created_dirs else None
+        created_dirs.add(directory)
+        await asyncio.to_thread(self._write_file, output_path, content, new_directory)
+
+    async def _save_results(
+        self, modified_files: dict[str, str], output_dir: str
+    ) -> None:
+        """Save modified files to the output directory"""
+        output_paths = {
+            file_path: os.path.join(output_dir, file_path)
+            for file_path in modified_files
+        }
+
+        # Create each directory once rather than once per file
+        directories = {os.path.dirname(path) for path in output_paths.values()}
+        for directory in directories | {output_dir}:
+            os.makedirs(directory, exist_ok=True)
+
+        # Write the files concurrently off the event loop
+        await asyncio.gather(
+            *[
+                asyncio.to_thread(self._write_file, output_paths[file_path], content)
+                for file_path, content in modified_files.items()
+            ]
+        )
 
         logger.info(f"Saved {len(modified_files)} modified files to {output_dir}")
+
+    def _write_file(
+        self, output_path: str, content: str, directory: Optional[str] = None
+    ) -> None:
+        """Write a single file to disk, creating the given directory first"""
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(output_path, "w") as f:
+            f.write(content)
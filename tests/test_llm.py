@@ -0,0 +1,58 @@
+import json
+import unittest
+
+from terraform_agents.llm import LLMClient
+
+
+def fenced(data) -> str:
+    """Wrap data in a JSON code block like the model does"""
+    return f"Here are the changes:\n```json\n{json.dumps(data, indent=2)}\n```"
+
+
+class ExtractModifiedFilesTest(unittest.TestCase):
+    """Tests for parsing the different response shapes returned by the LLM"""
+
+    def setUp(self):
+        self.client = LLMClient(api_key="test", cache_dir=None)
+
+    def test_object_of_contents(self):
+        response = fenced({"file_0": "a", "file_1": "b"})
+        self.assertEqual(
+            self.client._extract_modified_files(response),
+            {"file_0": "a", "file_1": "b"},
+        )
+
+    def test_list_of_rows(self):
+        response = fenced(
+            [
+                {"id": "file_0", "path": "main.tf", "content": "a"},
+                {"id": "file_1", "path": "variables.tf", "content": "b"},
+            ]
+        )
+        self.assertEqual(
+            self.client._extract_modified_files(response),
+            {"file_0": "a", "file_1": "b"},
+        )
+
+    def test_non_string_values_are_dropped(self):
+        response = fenced({"file_0": {"content": "a"}, "file_1": "b", "file_2": None})
+        self.assertEqual(self.client._extract_modified_files(response), {"file_1": "b"})
+
+    def test_unexpected_shape_is_a_failed_response(self):
+        for data in ("main.tf", 42, [["file_0", "a"]], [{"id": ["file_0"]}]):
+            with self.subTest(data=data):
+                self.assertEqual(self.client._extract_modified_files(fenced(data)), {})
+
+    def test_list_response_is_mapped_to_paths(self):
+        files = {"main.tf": "x", "variables.tf": "y"}
+        response = fenced([{"id": "file_1", "path": "variables.tf", "content": "b"}])
+        self.assertEqual(
+            self.client._map_file_ids(
+                self.client._extract_modified_files(response), files
+            ),
+            {"variables.tf": "b"},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()